@@ -9,14 +9,14 @@ with bike_point_db as (
     select
         Id as station_id,
         TerminalName as station_id_
-    from {{ source('staging', 'bike_point') }}
+    from {{ source('staging', 'bike_point') }} final
 
     union all
 
     select
         Id as station_id,
         Id as station_id_
-    from {{ source('staging', 'bike_point') }}
+    from {{ source('staging', 'bike_point') }} final
 )
 
 select
@@ -0,0 +1,152 @@
+"""
+Compare the per-record and columnar parsing of the BikePoint JSON.
+
+Usage:
+    python benchmarks/bikepoints_parsing.py [--path workdir/metainfo_bike_point.json] [--copies 20]
+
+The payload saved by `etl_bikepoints_to_s3` is used when available, otherwise a synthetic
+one with ~800 stations is generated. The stations are replicated `--copies` times
+to get a multi-MB payload. Both parsers must produce equal DataFrames.
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+import pandas as pd
+
+from io import StringIO
+from pathlib import Path
+
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "flows"))
+
+from etl_bikepoints_to_s3 import create_dataframe
+
+
+def create_dataframe_legacy(path: Path) -> pd.DataFrame:
+    def make_record(record: Dict) -> Dict:
+        row = {
+            "Id":   int(record["id"].split("_")[-1]),
+            "Name": re.sub(r"\s*,\s*", ", ", record["commonName"]),
+            "Lat":  float(record["lat"]),
+            "Lon":  float(record["lon"]),
+        }
+
+        properties = {item["key"]: item["value"] for item in record["additionalProperties"]}
+        row.update(properties)
+
+        return row
+
+    content = json.load(path.open())
+    df = pd.DataFrame([make_record(record) for record in content])
+
+    df["Lat"] = df["Lat"].astype("float32")
+    df["Lon"] = df["Lon"].astype("float32")
+
+    df["TerminalName"] = df["TerminalName"].astype(int)
+
+    df["Installed"] = df["Installed"] == "true"
+    df["Locked"] = df["Locked"] == "true"
+    df["Temporary"] = df["Temporary"] == "true"
+    df["NbBikes"] = df["NbBikes"].astype("int8")
+    df["NbEmptyDocks"] = df["NbEmptyDocks"].astype("int8")
+    df["NbDocks"] = df["NbDocks"].astype("int8")
+    df["NbStandardBikes"] = df["NbStandardBikes"].astype("int8")
+    df["NbEBikes"] = df["NbEBikes"].astype("int8")
+
+    df.drop(columns=["InstallDate", "RemovalDate"], inplace=True)
+
+    return df
+
+
+def make_payload(num_stations: int = 800, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+
+    def make_property(key: str, value: str) -> Dict:
+        return {
+            "$type": "Tfl.Api.Presentation.Entities.AdditionalProperties, Tfl.Api.Presentation.Entities",
+            "category": "Description",
+            "key": key,
+            "sourceSystemKey": "BikePoints",
+            "value": value,
+            "modified": "2023-04-01T10:00:00.000Z",
+        }
+
+    payload = []
+    for i in range(1, num_stations + 1):
+        nb_docks = rng.randint(10, 60)
+        nb_bikes = rng.randint(0, nb_docks)
+        nb_ebikes = rng.randint(0, nb_bikes)
+        payload.append({
+            "$type": "Tfl.Api.Presentation.Entities.Place, Tfl.Api.Presentation.Entities",
+            "id": f"BikePoints_{i}",
+            "url": f"/Place/BikePoints_{i}",
+            "commonName": f"Street {i} ,Area {i % 50}",
+            "placeType": "BikePoint",
+            "additionalProperties": [
+                make_property("TerminalName", str(rng.randint(1_000, 310_000))),
+                make_property("Installed", "true"),
+                make_property("Locked", rng.choice(["true", "false"])),
+                make_property("InstallDate", str(rng.randint(1_270_000_000_000, 1_600_000_000_000))),
+                make_property("RemovalDate", ""),
+                make_property("Temporary", "false"),
+                make_property("NbBikes", str(nb_bikes)),
+                make_property("NbEmptyDocks", str(nb_docks - nb_bikes)),
+                make_property("NbDocks", str(nb_docks)),
+                make_property("NbStandardBikes", str(nb_bikes - nb_ebikes)),
+                make_property("NbEBikes", str(nb_ebikes)),
+            ],
+            "children": [],
+            "childrenUrls": [],
+            "lat": 51.5 + rng.uniform(-0.1, 0.1),
+            "lon": -0.12 + rng.uniform(-0.2, 0.2),
+        })
+
+    return payload
+
+
+def measure(func, path: Path, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(StringIO()):
+            func(path)
+        timings.append(time.perf_counter() - start)
+    return 1000 * min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", type=Path, default=Path("workdir/metainfo_bike_point.json"))
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.path.exists():
+        payload = json.load(args.path.open())
+    else:
+        print(f"No payload at {args.path}, using synthetic data")
+        payload = make_payload()
+
+    payload = payload * args.copies
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "bike_point.json"
+        json.dump(payload, path.open('w'), indent=4, separators=(', ', ': '), ensure_ascii=False)
+
+        with contextlib.redirect_stdout(StringIO()):
+            pd.testing.assert_frame_equal(create_dataframe_legacy(path), create_dataframe(path))
+
+        print(f"payload: {len(payload)} stations, {path.stat().st_size / 2 ** 20:.1f} MB")
+        print(f"per-record: {measure(create_dataframe_legacy, path, args.repeats):.1f} ms")
+        print(f"columnar:   {measure(create_dataframe, path, args.repeats):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
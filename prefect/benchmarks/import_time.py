@@ -0,0 +1,88 @@
+"""
+Measure import time of the flow module behind every deployment entry point.
+
+Usage:
+    python benchmarks/import_time.py [--top 10] [--repeats 5]
+
+Each `*-deployment.yaml` entry point is imported `--repeats` times in a fresh interpreter
+with `python -X importtime`, the script reports the fastest wall time of the import and
+the top-level packages that take most of it in that run.
+"""
+import re
+import sys
+import argparse
+import subprocess
+
+from pathlib import Path
+from collections import defaultdict
+
+from typing import Dict, List, Tuple
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# NOTE: Prefect puts the directory of the flow on `sys.path` while it loads the module
+IMPORT_CODE = '''
+import sys
+import time
+import importlib.util
+
+sys.path.insert(0, {dir!r})
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("flow_module", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+'''
+
+
+def find_entrypoints() -> List[str]:
+    entrypoints = []
+    for path in sorted(ROOT.glob("*-deployment.yaml")):
+        match = re.search(r"^entrypoint:\s*(\S+)", path.read_text(), flags=re.MULTILINE)
+        if match is not None:
+            entrypoints.append(match.group(1))
+    return entrypoints
+
+
+def measure(entrypoint: str) -> Tuple[float, Dict[str, int]]:
+    path, _ = entrypoint.split(":")
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_CODE.format(path=str(ROOT / path), dir=str((ROOT / path).parent))],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # NOTE: lines look like `import time:   self [us] |  cumulative | imported package`,
+    #       cumulative time of a module includes its nested imports
+    packages = defaultdict(int)
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match is None or match.group(2):
+            continue
+        packages[match.group(3).split(".")[0]] += int(match.group(1))
+
+    return float(result.stdout.strip().splitlines()[-1]), packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    for entrypoint in find_entrypoints():
+        wall_time, packages = min((measure(entrypoint) for _ in range(args.repeats)), key=lambda m: m[0])
+        print(f"{entrypoint}: {1000 * wall_time:.0f} ms")
+
+        packages = sorted(packages.items(), key=lambda p: p[1], reverse=True)[:args.top]
+        for package, cumulative in packages:
+            print(f"    {package:<24}{cumulative / 1000:>8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
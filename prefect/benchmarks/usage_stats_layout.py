@@ -0,0 +1,172 @@
+"""
+Compare rows read by the datamart queries on the legacy and tuned `usage_stats` layouts.
+
+Usage:
+    python benchmarks/usage_stats_layout.py [--source usage_stats] [--partitions 8]
+
+The latest partitions of the source table are copied into `usage_stats_bench_legacy`
+(the old DDL) and `usage_stats_bench_tuned` (the DDL of `etl_usagestats_to_ch`).
+The three datamart aggregations and their dashboard filters are run against both
+tables, `read_rows`, `read_bytes` and duration are taken from `system.query_log`.
+"""
+import sys
+import time
+import uuid
+import argparse
+
+import pandas as pd
+
+from pathlib import Path
+
+from prefect_sqlalchemy import SqlAlchemyConnector
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "flows"))
+
+from etl_usagestats_to_ch import create_table
+
+
+def create_legacy_table(table: str) -> str:
+    return f'''
+    CREATE TABLE IF NOT EXISTS default.{table}
+    (
+        rental_id               Int64,
+        bike_id                 Int64,
+        start_datetime          DateTime,
+        start_station_id        Int64,
+        start_station_name      String,
+        end_datetime            DateTime,
+        end_station_id          Int64,
+        end_station_name        String,
+        dwh_partition           Int64
+    )
+    ENGINE = MergeTree()
+    PARTITION BY dwh_partition
+    ORDER BY start_datetime
+    SETTINGS index_granularity = 8192
+    '''
+
+
+def drop_table(table: str) -> str:
+    return f'DROP TABLE IF EXISTS default.{table}'
+
+
+QUERIES = {
+    "cnt_rides_per_day": '''
+        SELECT toStartOfDay(start_datetime) AS dt, count(*), sum(end_datetime - start_datetime)
+        FROM default.{table}
+        GROUP BY dt
+    ''',
+    "duration_per_bike": '''
+        SELECT toStartOfDay(start_datetime) AS dt, bike_id, sum(end_datetime - start_datetime), count(rental_id)
+        FROM default.{table}
+        GROUP BY bike_id, dt
+    ''',
+    "popular_rides": '''
+        SELECT toStartOfDay(start_datetime) AS dt, start_station_id, end_station_id, count(*)
+        FROM default.{table}
+        GROUP BY dt, start_station_id, end_station_id
+    ''',
+    "duration_per_bike (one bike)": '''
+        SELECT toStartOfDay(start_datetime) AS dt, sum(end_datetime - start_datetime), count(rental_id)
+        FROM default.{table}
+        WHERE bike_id = {bike_id}
+        GROUP BY dt
+    ''',
+    "popular_rides (one station)": '''
+        SELECT toStartOfDay(start_datetime) AS dt, end_station_id, count(*)
+        FROM default.{table}
+        WHERE start_station_id = {station_id}
+        GROUP BY dt, end_station_id
+    ''',
+    "popular_rides (one route)": '''
+        SELECT toStartOfDay(start_datetime) AS dt, count(*)
+        FROM default.{table}
+        WHERE start_station_id = {station_id} AND end_station_id = {end_station_id}
+        GROUP BY dt
+    ''',
+}
+
+
+def run_queries(con, table: str, params: dict, tag: str) -> None:
+    for name, query in QUERIES.items():
+        query = query.format(table=table, **params)
+        con.execute(f"{query} SETTINGS log_comment = '{tag}:{table}:{name}'")
+
+
+def fetch_stats(con, tag: str, timeout: float = 30.0) -> pd.DataFrame:
+    sql_query = f'''
+        SELECT
+            splitByChar(':', log_comment)[2] AS table,
+            splitByChar(':', log_comment)[3] AS query,
+            read_rows,
+            formatReadableSize(read_bytes) AS read_bytes,
+            query_duration_ms
+        FROM system.query_log
+        WHERE type = 'QueryFinish' AND startsWith(log_comment, '{tag}:')
+        ORDER BY query, table
+    '''
+
+    # NOTE: query_log is flushed periodically, so wait for all queries to show up
+    deadline = time.monotonic() + timeout
+    while True:
+        df = pd.read_sql(sql_query, con.get_engine())
+        if df.shape[0] >= 2 * len(QUERIES) or time.monotonic() > deadline:
+            return df
+        time.sleep(1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="usage_stats")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--keep", action="store_true", help="keep benchmark tables")
+    args = parser.parse_args()
+
+    tables = {
+        "usage_stats_bench_legacy": create_legacy_table,
+        "usage_stats_bench_tuned": create_table,
+    }
+
+    with SqlAlchemyConnector.load("yandex-cloud-clickhouse-connector") as con:
+        partitions = pd.read_sql(f'''
+            SELECT DISTINCT dwh_partition
+            FROM default.{args.source}
+            ORDER BY dwh_partition DESC
+            LIMIT {args.partitions}
+        ''', con.get_engine())["dwh_partition"].tolist()
+        partitions = ", ".join(map(str, partitions))
+
+        for table, create in tables.items():
+            con.execute(drop_table(table))
+            con.execute(create(table))
+            con.execute(f'''
+                INSERT INTO default.{table}
+                SELECT * FROM default.{args.source}
+                WHERE dwh_partition IN ({partitions})
+            ''')
+            con.execute(f"OPTIMIZE TABLE default.{table} FINAL")
+
+        params = pd.read_sql(f'''
+            SELECT
+                any(bike_id) AS bike_id,
+                any(start_station_id) AS station_id,
+                any(end_station_id) AS end_station_id
+            FROM default.{args.source}
+            WHERE dwh_partition IN ({partitions})
+        ''', con.get_engine()).iloc[0].to_dict()
+
+        tag = f"bench-{uuid.uuid4().hex[:8]}"
+        for table in tables:
+            run_queries(con, table, params, tag)
+
+        df = fetch_stats(con, tag)
+
+        if not args.keep:
+            for table in tables:
+                con.execute(drop_table(table))
+
+    print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Compare the legacy and compact weather layouts on a year of data.
+
+Usage:
+    python benchmarks/weather_layout.py [--workdir workdir] [--year 2021]
+
+The partitions saved by `etl_weather_to_s3` into `<workdir>/<metric>/part_<YYYYMM>.parquet`
+are used when available, otherwise a year of synthetic data for ~800 stations is generated.
+Both layouts are written to a temporary directory, the script reports their sizes and
+the time needed to scan them back.
+"""
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+from typing import Dict, Optional
+
+
+METRICS = ['tasmin', 'tasmax', 'rainfall']
+
+
+def read_parquet(path: Path) -> pd.DataFrame:
+    # NOTE: `date32` dates are read as `datetime64` instead of python objects
+    return pq.read_table(path).to_pandas(date_as_object=False)
+
+
+def load_year(workdir: Path, year: int) -> pd.DataFrame:
+    df_joined = []
+
+    for metric in METRICS:
+        partitions = sorted((workdir / metric).glob(f"part_{year}??.parquet"))
+        if not partitions:
+            return None
+
+        df = pd.concat([read_parquet(p) for p in partitions])
+        df.set_index(["station_id", "date"], inplace=True)
+        df_joined.append(df)
+
+    return pd.concat(df_joined, axis=1).reset_index()
+
+
+def make_year(year: int, num_stations: int = 800, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    dates = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+    station_ids = np.sort(rng.choice(np.arange(1_000, 310_000), size=num_stations, replace=False))
+
+    df = pd.DataFrame({
+        "station_id": np.repeat(station_ids, len(dates)),
+        "date": np.tile(dates, num_stations),
+    })
+
+    season = 8 * np.sin(2 * np.pi * (df["date"].dt.dayofyear - 110) / 365)
+    noise = rng.normal(0, 2, size=df.shape[0])
+    df["tasmin"] = 6 + season + noise
+    df["tasmax"] = df["tasmin"] + rng.uniform(3, 10, size=df.shape[0])
+    df["rainfall"] = np.clip(rng.exponential(2, size=df.shape[0]) - 1, 0, None)
+
+    return df
+
+
+def to_legacy(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df["station_id"] = df["station_id"].astype("int64")
+    df["date"] = pd.to_datetime(df["date"])
+    for metric in METRICS:
+        df[metric] = df[metric].astype("float64")
+    return df
+
+
+def to_compact(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df["station_id"] = df["station_id"].astype("uint32")
+    for metric in METRICS:
+        df[metric] = df[metric].astype("float32").round(2)
+    return df
+
+
+COMPACT_SCHEMA = pa.schema(
+    [("station_id", pa.uint32()), ("date", pa.date32())] +
+    [(metric, pa.float32()) for metric in METRICS]
+)
+
+
+def measure(
+    df: pd.DataFrame,
+    path: Path,
+    compression: str,
+    schema: Optional[pa.Schema] = None,
+    repeats: int = 5,
+) -> Dict[str, float]:
+    df.sort_values(["date", "station_id"]).to_parquet(path, index=False, compression=compression, schema=schema)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        df_read = read_parquet(path)
+        df_read[METRICS].sum()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "size_mb": path.stat().st_size / 2 ** 20,
+        "memory_mb": df_read.memory_usage(deep=True).sum() / 2 ** 20,
+        "scan_ms": 1000 * min(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", type=Path, default=Path("workdir"))
+    parser.add_argument("--year", type=int, default=2021)
+    args = parser.parse_args()
+
+    df = load_year(args.workdir, args.year)
+    if df is None:
+        print(f"No partitions for {args.year} in {args.workdir}, using synthetic data")
+        df = make_year(args.year)
+
+    print("rows:", df.shape[0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        results = {
+            "legacy (gzip)": measure(to_legacy(df), tmpdir / "legacy.parquet", compression="gzip"),
+            "compact (zstd)": measure(
+                to_compact(df), tmpdir / "compact.parquet", compression="zstd", schema=COMPACT_SCHEMA,
+            ),
+        }
+
+    print(pd.DataFrame(results).T.round(2))
+
+
+if __name__ == "__main__":
+    main()
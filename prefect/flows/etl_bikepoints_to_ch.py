@@ -1,17 +1,16 @@
-import re
-import json
-import requests
-
 import pandas as pd
 
 from pathlib import Path
+from datetime import datetime, timezone
 
 from prefect import flow, task
 from prefect_sqlalchemy import SqlAlchemyConnector
 from prefect_aws import AwsCredentials
 from prefect_aws.s3 import S3Bucket
 
-from typing import Dict
+from typing import List
+
+from utils import get_block_size, get_row_width, get_version, insert_blocks, is_loaded, mark_loaded
 
 
 @task()
@@ -30,7 +29,8 @@ def fetch(workdir: Path) -> pd.DataFrame:
     s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
     s3_block.download_object_to_path(from_path=s3_path, to_path=workdir / s3_path)
 
-    return pd.read_parquet(workdir / s3_path)
+    columns = ["Id", "Name", "TerminalName", "Lat", "Lon", "Installed", "Locked", "Temporary"]
+    return pd.read_parquet(workdir / s3_path, columns=columns)
 
 
 def create_table(table: str) -> str:
@@ -45,47 +45,124 @@ def create_table(table: str) -> str:
         Installed         Bool,
         Locked            Bool,
         Temporary         Bool,
-        NbBikes           Int8,
-        NbEmptyDocks      Int8,
-        NbDocks           Int8,
-        NbStandardBikes   Int8,
-        NbEBikes          Int8
+        updated_at        DateTime('UTC')
     )
-    ENGINE = MergeTree()
+    ENGINE = ReplacingMergeTree(updated_at)
     ORDER BY Id
     PRIMARY KEY Id
     '''
 
 
+def create_status_table(table: str) -> str:
+    return f'''
+    CREATE TABLE IF NOT EXISTS default.{table}
+    (
+        Id                UInt16                CODEC(ZSTD),
+        snapshot_ts       DateTime('UTC')       CODEC(DoubleDelta, ZSTD),
+        NbBikes           UInt8                 CODEC(ZSTD),
+        NbEmptyDocks      UInt8                 CODEC(ZSTD),
+        NbDocks           UInt8                 CODEC(ZSTD),
+        NbStandardBikes   UInt8                 CODEC(ZSTD),
+        NbEBikes          UInt8                 CODEC(ZSTD)
+    )
+    ENGINE = ReplacingMergeTree()
+    PARTITION BY toYYYYMM(snapshot_ts)
+    ORDER BY (Id, snapshot_ts)
+    '''
+
+
 def drop_table(table: str) -> str:
     return f'DROP TABLE IF EXISTS default.{table}'
 
 
-@task()
-def upload_ch(df: pd.DataFrame, table: str) -> None:
+def get_table_engine(table: str) -> str:
+    return f"SELECT engine FROM system.tables WHERE database = 'default' AND name = '{table}'"
+
+
+@task(log_prints=True)
+def upload_ch(df: pd.DataFrame, table: str, memory_budget_mb: float = 128) -> None:
+    df = df.assign(updated_at=datetime.now(timezone.utc).replace(microsecond=0))
+
+    row_width = get_row_width(df)
+    block_size = get_block_size(row_width, memory_budget_mb)
+    print(f"Insert blocks: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, block_size={block_size}")
+
     with SqlAlchemyConnector.load("yandex-cloud-clickhouse-connector") as con:
         print("Connection:", con)
         print("Engine:", con.get_engine())
-        
-        sql_query = drop_table(table)
-        con.execute(sql_query)
+
+        # NOTE: the snapshot table used to be dropped and recreated on every run,
+        #       replace it once with the upserted one
+        engine = pd.read_sql(get_table_engine(table), con.get_engine())["engine"].tolist()
+        if engine and engine[0] != "ReplacingMergeTree":
+            sql_query = drop_table(table)
+            con.execute(sql_query)
 
         sql_query = create_table(table)
         con.execute(sql_query)
 
-        df.to_sql(
-            name=table,
-            con=con.get_engine(),
-            chunksize=100_000,
-            if_exists="append",
-            index=False,
-        )
+        insert_blocks(df, table, con, block_size)
+
+
+def read_status(paths: List[Path]) -> List[pd.DataFrame]:
+    # NOTE: runs may overlap, a snapshot flushed twice is collapsed by `ReplacingMergeTree`
+    #       and a snapshot already removed by the other run is skipped
+    dfs = []
+    for path in paths:
+        try:
+            dfs.append(pd.read_parquet(path))
+        except FileNotFoundError:
+            continue
+    return dfs
+
+
+@task(log_prints=True)
+def flush_status(workdir: Path, table: str, memory_budget_mb: float = 128) -> None:
+    paths = sorted((workdir / "bike_point_status").glob("status_*.parquet"))
+    print("Buffered snapshots:", len(paths))
+
+    dfs_sample = read_status(paths[:1])
+    if not dfs_sample:
+        return
+
+    # NOTE: buffered snapshots are flushed in groups, so a long backlog
+    #       (e.g. after ClickHouse was unavailable) fits into the budget
+    row_width = get_row_width(dfs_sample[0])
+    block_size = get_block_size(row_width, memory_budget_mb)
+    paths_per_block = max(1, block_size // max(dfs_sample[0].shape[0], 1))
+    print(f"Insert blocks: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, "
+          f"block_size={block_size}, snapshots_per_block={paths_per_block}")
+
+    with SqlAlchemyConnector.load("yandex-cloud-clickhouse-connector") as con:
+        sql_query = create_status_table(table)
+        con.execute(sql_query)
+
+        for i in range(0, len(paths), paths_per_block):
+            paths_block = paths[i:i + paths_per_block]
+
+            dfs = read_status(paths_block)
+            if dfs:
+                df = pd.concat(dfs, ignore_index=True)
+                print(f"rows: {df.shape[0]}")
+                block_size = insert_blocks(df, table, con, block_size)
+
+            for path in paths_block:
+                path.unlink(missing_ok=True)
 
 
 @flow(log_prints=True)
-def etl_bikepoints_to_ch():
+def etl_bikepoints_to_ch(force: bool = False, memory_budget_mb: float = 128):
     workdir = prepare_env("workdir")
-    upload_ch(fetch(workdir), table="bike_point")
+
+    version = get_version(["metainfo_bike_point.parquet"])
+    marker = workdir / "loaded/bike_point.md5"
+    if force or not is_loaded(marker, version):
+        upload_ch(fetch(workdir), table="bike_point", memory_budget_mb=memory_budget_mb)
+        mark_loaded(marker, version)
+    else:
+        print("Stations metadata is not changed since the last load, skip")
+
+    flush_status(workdir, table="bike_point_status", memory_budget_mb=memory_budget_mb)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,14 @@
-import re
 import json
 import requests
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
+from datetime import datetime, timezone
 
 from prefect import flow, task
-from prefect_aws import AwsCredentials
-from prefect_aws.s3 import S3Bucket
 
-from typing import Dict
+from utils import upload_s3
 
 
 @task()
@@ -20,38 +19,68 @@ def prepare_env(workdir: str) -> Path:
     return workdir
 
 
-def create_dataframe(path: Path) -> pd.DataFrame:
-    def make_record(record: Dict) -> Dict:
-        row = {
-            "Id":   int(record["id"].split("_")[-1]),
-            "Name": re.sub(r"\s*,\s*", ", ", record["commonName"]),
-            "Lat":  float(record["lat"]),
-            "Lon":  float(record["lon"]),
-        }
-
-        properties = {item["key"]: item["value"] for item in record["additionalProperties"]}
-        row.update(properties)
-
-        return row
+def parse_bool(value: str) -> bool:
+    return value == "true"
 
-    content = json.load(path.open())
-    df = pd.DataFrame([make_record(record) for record in content])
 
-    df["Lat"] = df["Lat"].astype("float32")
-    df["Lon"] = df["Lon"].astype("float32")
+PROPERTIES = {
+    # key: (dtype, parser)
+    "TerminalName":     ("int64", int),
+    "Installed":        ("bool", parse_bool),
+    "Locked":           ("bool", parse_bool),
+    "Temporary":        ("bool", parse_bool),
+    "NbBikes":          ("int8", int),
+    "NbEmptyDocks":     ("int8", int),
+    "NbDocks":          ("int8", int),
+    "NbStandardBikes":  ("int8", int),
+    "NbEBikes":         ("int8", int),
+}
 
-    df["TerminalName"] = df["TerminalName"].astype(int)
 
-    df["Installed"] = df["Installed"] == "true"
-    df["Locked"] = df["Locked"] == "true"
-    df["Temporary"] = df["Temporary"] == "true"
-    df["NbBikes"] = df["NbBikes"].astype("int8")
-    df["NbEmptyDocks"] = df["NbEmptyDocks"].astype("int8")
-    df["NbDocks"] = df["NbDocks"].astype("int8")
-    df["NbStandardBikes"] = df["NbStandardBikes"].astype("int8")
-    df["NbEBikes"] = df["NbEBikes"].astype("int8")
-
-    df.drop(columns=["InstallDate", "RemovalDate"], inplace=True)
+def create_dataframe(path: Path) -> pd.DataFrame:
+    # NOTE: records are parsed in one pass straight into typed column arrays,
+    #       properties absent from `PROPERTIES` (e.g. InstallDate, RemovalDate) are skipped;
+    #       records missing any of `PROPERTIES` are dropped, typed arrays have no NULLs
+    #       and a default value would pass for a real reading (e.g. 0 bikes)
+    with path.open() as fd:
+        content = json.load(fd)
+
+    num_records = len(content)
+
+    ids = np.empty(num_records, dtype="int64")
+    names = np.empty(num_records, dtype="object")
+    lats = np.empty(num_records, dtype="float32")
+    lons = np.empty(num_records, dtype="float32")
+    properties = {key: np.empty(num_records, dtype=dtype) for key, (dtype, _) in PROPERTIES.items()}
+    complete = np.empty(num_records, dtype="bool")
+
+    for i, record in enumerate(content):
+        record_id = record["id"]
+        ids[i] = int(record_id[record_id.rfind("_") + 1:])
+        names[i] = record["commonName"]
+        lats[i] = record["lat"]
+        lons[i] = record["lon"]
+
+        keys = set()
+        for item in record["additionalProperties"]:
+            key = item["key"]
+            if key in PROPERTIES:
+                properties[key][i] = PROPERTIES[key][1](item["value"])
+                keys.add(key)
+        complete[i] = len(keys) == len(PROPERTIES)
+
+    df = pd.DataFrame({
+        "Id":   ids,
+        "Name": pd.Series(names, dtype="object").str.replace(r"\s*,\s*", ", ", regex=True),
+        "Lat":  lats,
+        "Lon":  lons,
+        **properties,
+    })
+
+    num_incomplete = num_records - int(complete.sum())
+    if num_incomplete:
+        print("Drop records with missing properties:", num_incomplete)
+        df = df[complete].reset_index(drop=True)
 
     print("Partition info:")
     print(df.head(5))
@@ -61,33 +90,58 @@ def create_dataframe(path: Path) -> pd.DataFrame:
     return df
 
 
-@task(retries=3)
-def fetch(path: str) -> Path:
-    page = requests.get("https://api.tfl.gov.uk/BikePoint/")
-    path = Path(path)
-    json.dump(page.json(), path.open('w'), indent=4, separators=(', ', ': '), ensure_ascii=False)
-    return path
+# NOTE: metadata of stations changes rarely and is kept in `metainfo_bike_point.parquet`,
+#       availability changes every minute and is buffered locally as a time series
+META_COLUMNS = ["Id", "Name", "TerminalName", "Lat", "Lon", "Installed", "Locked", "Temporary"]
+STATUS_COLUMNS = ["NbBikes", "NbEmptyDocks", "NbDocks", "NbStandardBikes", "NbEBikes"]
 
 
 @task()
-def upload_s3(path_local: str, path_remote: str) -> None:
-    AwsCredentials.load("yandex-cloud-s3-credentials")
-    s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
-    s3_block.upload_from_path(from_path=path_local, to_path=path_remote)
+def save_status(df: pd.DataFrame, snapshot_ts: datetime, workdir: Path) -> Path:
+    df_status = df[["Id"] + STATUS_COLUMNS].copy()
+    df_status.insert(1, "snapshot_ts", snapshot_ts)
+
+    (workdir / "bike_point_status").mkdir(parents=True, exist_ok=True)
+    path = workdir / f"bike_point_status/status_{snapshot_ts:%Y%m%d%H%M%S}.parquet"
+
+    # NOTE: write and rename, so `etl_bikepoints_to_ch` never flushes a partial file
+    path_tmp = path.with_name(f".{path.name}.tmp")
+    df_status.to_parquet(path_tmp, index=False)
+    path_tmp.rename(path)
+
+    return path
+
+
+@task(retries=3)
+def fetch(path: str, chunk_size: int = 1024 * 1024) -> Path:
+    # NOTE: the response is streamed to disk as is, it is parsed only once by `create_dataframe`
+    page = requests.get("https://api.tfl.gov.uk/BikePoint/", stream=True)
+    page.raise_for_status()
+
+    path = Path(path)
+    with path.open('wb') as fd:
+        for data in page.iter_content(chunk_size=chunk_size):
+            fd.write(data)
+    return path
 
 
 @flow(log_prints=True)
 def etl_bikepoints_to_s3():
     workdir = prepare_env("workdir")
+    snapshot_ts = datetime.now(timezone.utc).replace(microsecond=0)
 
     path_json = "metainfo_bike_point.json"
-    upload_s3(fetch(workdir / path_json), path_json)
+    fetch(workdir / path_json)
 
     df = create_dataframe(workdir / path_json)
-    
+    save_status(df, snapshot_ts, workdir)
+
+    # NOTE: raw JSON changes on every poll because of the availability values,
+    #       so it is archived only together with changed stations metadata
     path_parquet = "metainfo_bike_point.parquet"
-    df.to_parquet(workdir / path_parquet, index=False, compression="gzip")
-    upload_s3(workdir / path_parquet, path_parquet)
+    df[META_COLUMNS].to_parquet(workdir / path_parquet, index=False, compression="gzip")
+    if upload_s3(workdir / path_parquet, path_parquet):
+        upload_s3(workdir / path_json, path_json)
 
 
 if __name__ == "__main__":
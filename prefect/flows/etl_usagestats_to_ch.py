@@ -1,8 +1,5 @@
 import re
 
-import pandas as pd
-
-from io import StringIO 
 from pathlib import Path
 
 from prefect import flow, task
@@ -12,6 +9,8 @@ from prefect_sqlalchemy import SqlAlchemyConnector
 
 from typing import List, Optional
 
+from utils import get_block_size, get_row_width, get_version, insert_blocks, is_loaded, mark_loaded
+
 
 @task()
 def prepare_env(workdir: str) -> Path:
@@ -22,8 +21,8 @@ def prepare_env(workdir: str) -> Path:
 
 
 @task(log_prints=True)
-def fetch_partition(partition_num: int, workdir: Path) -> pd.DataFrame:
-    partition_local = str(workdir / f"part_{partition_num:05d}.parquet")
+def fetch_partition(partition_num: int, workdir: Path) -> Path:
+    partition_local = workdir / f"part_{partition_num:05d}.parquet"
     partition_s3 = f"usage-stats/part_{partition_num:05d}.parquet"
     
     print(f"Processing partition:", partition_s3)
@@ -33,28 +32,49 @@ def fetch_partition(partition_num: int, workdir: Path) -> pd.DataFrame:
     s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
     s3_block.download_object_to_path(
         from_path=partition_s3,
-        to_path=partition_local,
+        to_path=str(partition_local),
     )
 
-    df = pd.read_parquet(partition_local)
-    df["dwh_partition"] = partition_num
+    return partition_local
+
+
+# NOTE: datamarts and dashboards group by day and filter by bike and station ids,
+#       so codecs and projections are tuned for these access paths
+COLUMNS = [
+    # (name, type, codec)
+    ("rental_id",           "Int64",                    "Delta, ZSTD"),
+    ("bike_id",             "Int64",                    "ZSTD"),
+    ("start_datetime",      "DateTime",                 "DoubleDelta, ZSTD"),
+    ("start_station_id",    "Int64",                    "ZSTD"),
+    ("start_station_name",  "LowCardinality(String)",   None),
+    ("end_datetime",        "DateTime",                 "Delta, ZSTD"),
+    ("end_station_id",      "Int64",                    "ZSTD"),
+    ("end_station_name",    "LowCardinality(String)",   None),
+    ("dwh_partition",       "Int64",                    "T64, ZSTD"),
+]
 
-    return df
+PROJECTIONS = [
+    # (name, query)
+    ("prj_stations",    "SELECT * ORDER BY (start_station_id, end_station_id, start_datetime)"),
+    ("prj_bike",        "SELECT * ORDER BY (bike_id, start_datetime)"),
+]
 
 
 def create_table(table: str) -> str:
+    columns = [
+        f"{name:<24}{type_:<28}" + (f"CODEC({codec})" if codec else "")
+        for name, type_, codec in COLUMNS
+    ]
+    columns += [
+        f"PROJECTION {name} ({query})"
+        for name, query in PROJECTIONS
+    ]
+    columns = ",\n        ".join(c.rstrip() for c in columns)
+
     return f'''
     CREATE TABLE IF NOT EXISTS default.{table}
     (
-        rental_id               Int64,
-        bike_id                 Int64,
-        start_datetime          DateTime,
-        start_station_id        Int64,
-        start_station_name      String,
-        end_datetime            DateTime,
-        end_station_id          Int64,
-        end_station_name        String,
-        dwh_partition           Int64
+        {columns}
     )
     ENGINE = MergeTree()
     PARTITION BY dwh_partition
@@ -63,12 +83,42 @@ def create_table(table: str) -> str:
     '''
 
 
+def get_table_query(table: str) -> str:
+    return f"SELECT create_table_query FROM system.tables WHERE database = 'default' AND name = '{table}'"
+
+
+def alter_table(table: str, table_query: str) -> List[str]:
+    # NOTE: brings projections to a table created with an older layout; unchanged
+    #       partitions are never reloaded, so existing parts are materialized once,
+    #       when the projection is added
+    sql_queries = []
+    for name, query in PROJECTIONS:
+        if f"PROJECTION {name} " not in table_query:
+            sql_queries += [
+                f'ALTER TABLE default.{table} ADD PROJECTION IF NOT EXISTS {name} ({query})',
+                f'ALTER TABLE default.{table} MATERIALIZE PROJECTION {name}',
+            ]
+    return sql_queries
+
+
 def drop_partition_table(table: str, partition_num: int) -> str:
     return f'ALTER TABLE default.{table} DROP PARTITION {partition_num}'
 
 
-@task(retries=2)
-def upload_ch(df: pd.DataFrame, table: str, partition_num: int) -> None:
+@task(retries=2, log_prints=True)
+def upload_ch(path: Path, table: str, partition_num: int, memory_budget_mb: float = 512) -> None:
+    # NOTE: pandas is imported only when the partition is not skipped
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    # NOTE: the partition is read in batches of the insert block size
+    parquet_file = pq.ParquetFile(path)
+    df_sample = next(parquet_file.iter_batches(batch_size=1000)).to_pandas()
+
+    row_width = get_row_width(df_sample)
+    block_size = get_block_size(row_width, memory_budget_mb)
+    print(f"Insert blocks: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, block_size={block_size}")
+
     with SqlAlchemyConnector.load("yandex-cloud-clickhouse-connector") as con:
         print("Connection:", con)
         print("Engine:", con.get_engine())
@@ -76,26 +126,37 @@ def upload_ch(df: pd.DataFrame, table: str, partition_num: int) -> None:
         sql_query = create_table(table)
         con.execute(sql_query)
 
+        table_query = pd.read_sql(get_table_query(table), con.get_engine())["create_table_query"].iloc[0]
+        for sql_query in alter_table(table, table_query):
+            print("Alter table:", sql_query)
+            con.execute(sql_query)
+
         sql_query = drop_partition_table(table, partition_num=partition_num)
         con.execute(sql_query)
 
-        df.to_sql(
-            name=table,
-            con=con.get_engine(),
-            chunksize=100_000,
-            if_exists="append",
-            index=False,
-        )
+        for batch in parquet_file.iter_batches(batch_size=block_size):
+            df = batch.to_pandas()
+            df["dwh_partition"] = partition_num
+            block_size = insert_blocks(df, table, con, block_size)
 
 
 @flow(log_prints=True)
-def etl_usagestats_to_ch(partition_num: int) -> None:
+def etl_usagestats_to_ch(partition_num: int, force: bool = False, memory_budget_mb: float = 512) -> None:
     workdir = prepare_env("workdir")
+
+    version = get_version([f"usage-stats/part_{partition_num:05d}.parquet"])
+    marker = workdir / f"loaded/usage_stats/part_{partition_num:05d}.md5"
+    if not force and is_loaded(marker, version):
+        print("Partition is not changed since the last load, skip:", partition_num)
+        return
+
     upload_ch(
         fetch_partition(partition_num, workdir=workdir),
         table="usage_stats",
         partition_num=partition_num,
+        memory_budget_mb=memory_budget_mb,
     )
+    mark_loaded(marker, version)
 
 
 @task(log_prints=True)
@@ -115,12 +176,17 @@ def list_partitions(latest: Optional[int] = None) -> List[int]:
 
 
 @flow(log_prints=True)
-def etl_usagestats_to_ch_multiple(partitions_num: Optional[List[int]] = None, latest: int = 50) -> None:
+def etl_usagestats_to_ch_multiple(
+    partitions_num: Optional[List[int]] = None,
+    latest: int = 50,
+    force: bool = False,
+    memory_budget_mb: float = 512,
+) -> None:
     if partitions_num is None:
         partitions_num = list_partitions(latest)
 
     for partition_num in partitions_num:
-        etl_usagestats_to_ch(partition_num)
+        etl_usagestats_to_ch(partition_num, force=force, memory_budget_mb=memory_budget_mb)
 
 
 if __name__ == "__main__":
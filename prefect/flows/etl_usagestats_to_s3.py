@@ -1,19 +1,29 @@
 import re
 import requests
 
-import numpy as np
 import pandas as pd
 import lxml.html as lhtml
 
-from io import StringIO
+from io import BytesIO
 from pathlib import Path
-from functools import reduce
+from functools import partial
+from itertools import islice
 
 from prefect import flow, task
-from prefect_aws import AwsCredentials
-from prefect_aws.s3 import S3Bucket
+from prefect.futures import PrefectFuture
 
-from typing import List, Optional
+from typing import List, Optional, Tuple
+
+from utils import check_source, get_max_in_flight, get_row_width, process_in_flight, transform, upload_s3
+from transform_usagestats import create_partition
+
+
+HEADERS = {
+    'user-agent': (
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
+        'Chrome/110.0.0.0 YaBrowser/23.3.0.2318 Yowser/2.5 Safari/537.36'
+    ),
+}
 
 
 @task()
@@ -48,117 +58,110 @@ def find_available_partitions(latest: Optional[int] = None) -> List[str]:
     return partitions
 
 
-@task(retries=0, log_prints=True)
-def fetch(partition_url: str) -> pd.DataFrame:
+@task(retries=2, log_prints=True)
+def fetch(partition_url: str, path: Path, chunk_size: int = 1024 * 1024) -> Path:
     print(f"partition_url={partition_url}")
 
-    headers = (
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko)'
-        'Chrome/110.0.0.0 YaBrowser/23.3.0.2318 Yowser/2.5 Safari/537.36'
-    )
-    headers = {'user-agent': headers}
-
-    content = requests.get(partition_url, headers=headers).text
-    content = StringIO(content)
-
-    df = pd.read_csv(content)
-    print("columns_raw = ", df.columns)
-
-    df.columns = df.columns.str.lower().str.replace(' ', '')
-
-    df.rename(columns={
-        "number":             "rental_id",
-        "rentalid":           "rental_id",
-        "bikenumber":         "bike_id",
-        "bikeid":             "bike_id",
-        "enddate":            "end_datetime",
-        "endstationid":       "end_station_id",
-        "endstationnumber":   "end_station_id",
-        "endstationname":     "end_station_name",
-        "endstation":         "end_station_name",
-        "startdate":          "start_datetime",
-        "startstationnumber": "start_station_id",
-        "startstationid":     "start_station_id",
-        "startstationname":   "start_station_name",
-        "startstation":       "start_station_name",
-    }, inplace=True)
-
-    # HOTFIX: because column names and number are incosistent
-    # if "end_station_id" not in df.columns:
-    #     df["end_station_id"] = -1
-
-    columns = [
-        "rental_id",
-        "bike_id",
-        "start_datetime",
-        "start_station_id",
-        "start_station_name",
-        "end_datetime",
-        "end_station_id",
-        "end_station_name",
-    ]
-    df = df[columns]
-
-    for col in ["start_datetime", "end_datetime"]:
-        try:
-            df[col] = pd.to_datetime(df[col])
-        except ValueError:
-            df[col] = pd.to_datetime(df[col], format="%d/%m/%Y %H:%M")
-
-    for col in ["start_station_name", "end_station_name"]:
-        df[col] = df[col].map(lambda s: re.sub(r"\s*,\s*", ", ", s))
-
-    # NOTE: Drop some incosistent IDs
-
-    mask = []
-    for col in ["rental_id", "bike_id", "start_station_id", "end_station_id"]:
-        mask_ = pd.to_numeric(df[col], errors="coerce").notnull()
-        mask.append(mask_)
-    mask = reduce(np.logical_and, mask)
-
-    df = df[mask]
-
-    for col in ["rental_id", "bike_id", "start_station_id", "end_station_id"]:
-        df[col] = df[col].astype(int)
-
-    print("Drop rows with bad IDs:", (~mask).sum())
-
-    print("Partition info:")
-    print(df.head(2))
-    print(f"cols:\n{df.dtypes}")
-    print(f"rows: {df.shape[0]}")
-
-    return df
+    page = requests.get(partition_url, headers=HEADERS, stream=True)
+    page.raise_for_status()
 
+    with path.open('wb') as fd:
+        for data in page.iter_content(chunk_size=chunk_size):
+            fd.write(data)
 
-@task()
-def save_partition(df: pd.DataFrame, path: Path) -> Path:
-    df.to_parquet(path, index=False, compression="gzip")
     return path
 
 
-@task()
-def upload_s3(path_local: str, path_remote: str) -> None:
-    AwsCredentials.load("yandex-cloud-s3-credentials")
-    s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
-    s3_block.upload_from_path(from_path=path_local, to_path=path_remote)
+@task(retries=2, log_prints=True)
+def get_partition_row_width(partition_url: str, nrows: int = 1000) -> float:
+    # NOTE: only the head of the extract is streamed to measure the row width
+    page = requests.get(partition_url, headers=HEADERS, stream=True)
+    page.raise_for_status()
 
+    with page:
+        lines = list(islice(page.iter_lines(), nrows + 1))
 
-@flow(log_prints=True)
-def process_partition(partition_path: str, workdir: Path) -> None:
+    return get_row_width(pd.read_csv(BytesIO(b"\n".join(lines))))
+
+
+def get_partition_paths(partition_path: str, workdir: Path) -> Tuple[str, Path, Path, Path]:
     partition_num = get_partition_num(partition_path)
     partition_url = "https://cycling.data.tfl.gov.uk/" + partition_path
 
-    df_partition = fetch(partition_url)
     partition_path = Path(f"part_{partition_num:05d}.parquet")
-    partition_local = save_partition(df_partition, workdir / partition_path)
-    partition_path = Path("usage-stats") / partition_path
+    partition_raw = workdir / partition_path.with_suffix(".csv")
+
+    return partition_url, partition_raw, workdir / partition_path, Path("usage-stats") / partition_path
+
+
+def submit_partition(
+    partition_path: str,
+    workdir: Path,
+    use_processes: bool = False,
+    force: bool = False,
+    memory_budget_mb: float = 512,
+) -> Optional[PrefectFuture]:
+    partition_url, partition_raw, partition_local, partition_remote = get_partition_paths(partition_path, workdir)
+
+    metadata = check_source(partition_url, partition_remote, force=force, headers=HEADERS)
+    if metadata is None:
+        return None
+
+    partition_raw = fetch.submit(partition_url, partition_raw)
+    partition_local = transform.submit(
+        create_partition,
+        partition_raw,
+        partition_local,
+        args=(memory_budget_mb,),
+        use_processes=use_processes,
+    )
+    return upload_s3.submit(partition_local, partition_remote, metadata=metadata)
 
-    upload_s3(partition_local, partition_path)
+
+# NOTE: smallest read chunk worth processing a partition with
+MIN_CHUNKSIZE = 10_000
+
+
+@flow(log_prints=True)
+def process_partitions(
+    partitions: List[str],
+    workdir: Path,
+    max_in_flight: int = 3,
+    use_processes: bool = False,
+    force: bool = False,
+    memory_budget_mb: float = 2048,
+) -> None:
+    # NOTE: with `use_processes` set `max_in_flight` around the number of cores keeps all of them busy;
+    #       partitions in flight share the budget, each gets at least `MIN_CHUNKSIZE` rows per chunk
+    if not partitions:
+        return
+
+    partition_url, *_ = get_partition_paths(partitions[0], workdir)
+    row_width = get_partition_row_width(partition_url)
+    max_in_flight = get_max_in_flight(row_width, MIN_CHUNKSIZE, memory_budget_mb, max_in_flight)
+    partition_budget_mb = memory_budget_mb / max_in_flight
+    print(f"Memory budget: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, "
+          f"max_in_flight={max_in_flight}, partition_budget_mb={partition_budget_mb:.0f}")
+
+    process_in_flight(
+        partitions,
+        partial(
+            submit_partition,
+            workdir=workdir,
+            use_processes=use_processes,
+            force=force,
+            memory_budget_mb=partition_budget_mb,
+        ),
+        max_in_flight,
+    )
 
 
 @flow(log_prints=True)
-def etl_usagestats_to_s3(partition_num: Optional[int] = None) -> None:
+def etl_usagestats_to_s3(
+    partition_num: Optional[int] = None,
+    force: bool = False,
+    memory_budget_mb: float = 512,
+) -> None:
     workdir = prepare_env("workdir")
 
     partitions = find_available_partitions()
@@ -172,21 +175,41 @@ def etl_usagestats_to_s3(partition_num: Optional[int] = None) -> None:
     if partition is None:
         raise KeyError("Partition is not available", partition_num)
     
-    process_partition(partition, workdir=workdir)
+    process_partitions([partition], workdir, max_in_flight=1, force=force, memory_budget_mb=memory_budget_mb)
 
 
 @flow(log_prints=True)
-def etl_usagestats_to_s3_multiple(partitions_num: Optional[List[int]] = None, latest: int = 50) -> None:
+def etl_usagestats_to_s3_multiple(
+    partitions_num: Optional[List[int]] = None,
+    latest: int = 50,
+    max_in_flight: int = 3,
+    use_processes: bool = False,
+    force: bool = False,
+    memory_budget_mb: float = 2048,
+) -> None:
     workdir = prepare_env("workdir")
-    
+
     if partitions_num is not None:
-        for partition_num in partitions_num:
-            etl_usagestats_to_s3(partition_num)
-        return
+        partitions = find_available_partitions()
+        partitions_dict = {get_partition_num(p): p for p in partitions}
 
-    partitions = find_available_partitions(latest)
-    for partition in partitions:
-        process_partition(partition, workdir=workdir)
+        partitions = []
+        for partition_num in partitions_num:
+            partition = partitions_dict.get(partition_num)
+            if partition is None:
+                raise KeyError("Partition is not available", partition_num)
+            partitions.append(partition)
+    else:
+        partitions = find_available_partitions(latest)
+
+    process_partitions(
+        partitions,
+        workdir=workdir,
+        max_in_flight=max_in_flight,
+        use_processes=use_processes,
+        force=force,
+        memory_budget_mb=memory_budget_mb,
+    )
 
 
 if __name__ == "__main__":
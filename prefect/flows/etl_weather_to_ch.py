@@ -1,20 +1,16 @@
-import re
-import requests
-
-import numpy as np
-import pandas as pd
-
 from pathlib import Path
-from urllib.parse import urlparse
-
-from tqdm.auto import tqdm
 
 from prefect import flow, task
 from prefect_aws import AwsCredentials
 from prefect_aws.s3 import S3Bucket
 from prefect_sqlalchemy import SqlAlchemyConnector
 
-from typing import List, Tuple, Optional
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+from utils import get_block_size, get_row_width, get_version, insert_blocks, is_loaded, mark_loaded
 
 
 @task()
@@ -25,14 +21,21 @@ def prepare_env(workdir: str) -> Path:
     return workdir
 
 
+METRICS = ['tasmin', 'tasmax', 'rainfall']
+
+
 @task(log_prints=True)
-def fetch_partitions(partition_num: int, workdir: Path) -> pd.DataFrame:
+def fetch_partitions(partition_num: int, workdir: Path) -> "pd.DataFrame":
+    # NOTE: pandas is imported only when the partition is not skipped
+    import pandas as pd
+    import pyarrow.parquet as pq
+
     AwsCredentials.load("yandex-cloud-s3-credentials")
     s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
 
     df_joined = []
 
-    for metric in ['tasmin', 'tasmax', 'rainfall']:
+    for metric in METRICS:
         (workdir / f"weather/{metric}").mkdir(parents=True, exist_ok=True)
 
         partition_s3 = f"weather/{metric}/part_{partition_num}.parquet"
@@ -44,7 +47,11 @@ def fetch_partitions(partition_num: int, workdir: Path) -> pd.DataFrame:
             to_path=partition_local,
         )
 
-        df = pd.read_parquet(partition_local)
+        # NOTE: `date32` dates are read as `datetime64` instead of python objects;
+        #       partitions written before the compact layout have wide types
+        df = pq.read_table(partition_local, columns=["station_id", "date", metric]).to_pandas(date_as_object=False)
+        df["station_id"] = df["station_id"].astype("uint32")
+        df[metric] = df[metric].astype("float32")
         df.set_index(["station_id", "date"], inplace=True)
         df_joined.append(df)
     
@@ -61,11 +68,11 @@ def create_table(table: str) -> str:
     return f'''
     CREATE TABLE IF NOT EXISTS default.{table}
     (
-        station_id              Int64,
-        date                    DateTime,
-        tasmin                  Float32,
-        tasmax                  Float32,
-        rainfall                Float32
+        station_id              UInt32      CODEC(Delta, ZSTD),
+        date                    Date        CODEC(Delta, ZSTD),
+        tasmin                  Float32     CODEC(Gorilla, ZSTD),
+        tasmax                  Float32     CODEC(Gorilla, ZSTD),
+        rainfall                Float32     CODEC(Gorilla, ZSTD)
     )
     ENGINE = MergeTree()
     PARTITION BY toYYYYMM(date)
@@ -78,8 +85,16 @@ def drop_partition_table(table: str, partition_num: int) -> str:
     return f'ALTER TABLE default.{table} DROP PARTITION {partition_num}'
 
 
-@task(retries=2)
-def upload_ch(df: pd.DataFrame, table: str, partition_num: int) -> None:
+@task(retries=2, log_prints=True)
+def upload_ch(df: "pd.DataFrame", table: str, partition_num: int, memory_budget_mb: float = 256) -> None:
+    # NOTE: the http driver renders datetimes with the time part,
+    #       so `Date` gets python dates, converted only for the insert
+    df = df.assign(date=df["date"].dt.date)
+
+    row_width = get_row_width(df)
+    block_size = get_block_size(row_width, memory_budget_mb)
+    print(f"Insert blocks: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, block_size={block_size}")
+
     with SqlAlchemyConnector.load("yandex-cloud-clickhouse-connector") as con:
         print("Connection:", con)
         print("Engine:", con.get_engine())
@@ -90,29 +105,36 @@ def upload_ch(df: pd.DataFrame, table: str, partition_num: int) -> None:
         sql_query = drop_partition_table(table, partition_num=partition_num)
         con.execute(sql_query)
 
-        df.to_sql(
-            name=table,
-            con=con.get_engine(),
-            chunksize=100_000,
-            if_exists="append",
-            index=False,
-        )
+        insert_blocks(df, table, con, block_size)
 
 
 @flow(log_prints=True)
-def etl_weather_to_ch(partition_num: int) -> None:
+def etl_weather_to_ch(partition_num: int, force: bool = False, memory_budget_mb: float = 256) -> None:
     workdir = prepare_env("workdir")
+
+    version = get_version([f"weather/{metric}/part_{partition_num}.parquet" for metric in METRICS])
+    marker = workdir / f"loaded/weather/part_{partition_num}.md5"
+    if not force and is_loaded(marker, version):
+        print("Partition is not changed since the last load, skip:", partition_num)
+        return
+
     upload_ch(
         fetch_partitions(partition_num, workdir=workdir),
         table="weather",
         partition_num=partition_num,
+        memory_budget_mb=memory_budget_mb,
     )
+    mark_loaded(marker, version)
 
 
 @flow(log_prints=True)
-def etl_weather_to_ch_multiple(partitions_num: List[int]) -> None:
+def etl_weather_to_ch_multiple(
+    partitions_num: List[int],
+    force: bool = False,
+    memory_budget_mb: float = 256,
+) -> None:
     for partition_num in partitions_num:
-        etl_weather_to_ch(partition_num)
+        etl_weather_to_ch(partition_num, force=force, memory_budget_mb=memory_budget_mb)
 
 
 if __name__ == "__main__":
@@ -1,26 +1,33 @@
 import re
 import requests
 
-import numpy as np
-import pandas as pd
-
 from pathlib import Path
+from functools import partial
 from urllib.parse import urlparse
 
 from tqdm.auto import tqdm
 
 from prefect import flow, task
+from prefect.futures import PrefectFuture
 from prefect_aws import AwsCredentials
 from prefect_aws.s3 import S3Bucket
 from prefect.blocks.system import Secret
 
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
+
+from utils import check_source, get_max_in_flight, get_row_width, process_in_flight, transform, upload_s3
+from transform_weather import create_dataframe, create_partition
 
 
 def progress_download(url: str, path: Path, chunk_size: int = 1024, **kwargs) -> Path:
     page = requests.get(url, stream=True, **kwargs)
     size = int(page.headers.get('content-length', 0))
 
+    # NOTE: the partition downloaded to measure its row width is not downloaded again
+    if size and path.exists() and path.stat().st_size == size:
+        page.close()
+        return path
+
     with path.open('wb') as fd, tqdm(
         desc=str(path),
         total=size,
@@ -65,109 +72,109 @@ def find_available_partitions(metric: str) -> List[str]:
 
 
 @task(retries=2, log_prints=True)
-def fetch(partition_url: str, workdir: Path) -> pd.DataFrame:
-    import netCDF4 as nc
-
+def fetch(partition_url: str, workdir: Path) -> Path:
     print(f"partition_url={partition_url}")
 
     _, partition_name = urlparse(partition_url).path.rsplit('/', 1)
     metric_name, metric_date = get_partition_name(partition_url)
 
     secret_block = Secret.load("ceda-archive-secret")
-    partition_local = progress_download(
+    return progress_download(
         partition_url,
         workdir / metric_name / partition_name,
         cookies={"ceda.session.1": secret_block.get()},
     )
 
-    try:
-        nc_data = nc.Dataset(partition_local)
-        nc_data_mask = ~nc_data[metric_name][:].mask.all(axis=0)
-        
-        df = pd.DataFrame({
-            'Lat': nc_data['latitude'][:][nc_data_mask],
-            'Lon': nc_data['longitude'][:][nc_data_mask],
-            metric_name: nc_data[metric_name][:][:, nc_data_mask].T.tolist(),
-        })
-    finally:
-        nc_data.close()
-
-    return df
-
 
 @task()
-def save_partition(df: pd.DataFrame, path: Path) -> Path:
-    df.to_parquet(path, index=False, compression="gzip")
-    return path
-
-
-@task()
-def fetch_bikepoints(workdir: Path) -> pd.DataFrame:
+def fetch_bikepoints(workdir: Path) -> Path:
     AwsCredentials.load("yandex-cloud-s3-credentials")
 
     s3_path = "metainfo_bike_point.parquet"
     s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
     s3_block.download_object_to_path(from_path=s3_path, to_path=workdir / s3_path)
 
-    return pd.read_parquet(workdir / s3_path)
+    return workdir / s3_path
 
 
 @task(log_prints=True)
-def match_weather_to_bikepoints(df_weather, df_bikepoints, partition_name):
-    from sklearn.neighbors import NearestNeighbors
-
-    metric_name, metric_date = partition_name
-    
-    print("Running kNN algroithm")
-    nn = NearestNeighbors(n_neighbors=1, metric='haversine')
-    nn.fit(df_weather[['Lat', 'Lon']])
-    _, indices = nn.kneighbors(df_bikepoints[['Lat', 'Lon']], return_distance=True)
-
-    print("Make joined algorithm")
-    df_joined = pd.DataFrame({
-        'station_id': df_bikepoints['TerminalName'].values,
-        metric_name: df_weather[metric_name].iloc[indices.ravel()],
-    })
-
-    num_days = len(df_joined[metric_name].iloc[0])
-    num_points = df_joined.shape[0]
-    print("num_days =", num_days)
-    print("num_points =", num_points)
-    
-    df_joined = df_joined.explode(metric_name)
-    df_joined['date'] = metric_date * 100 + np.tile(1 + np.arange(num_days), num_points)
-    df_joined['date'] = pd.to_datetime(df_joined['date'].map(str), format='%Y%m%d')
-
-    print("df_joined.shape =", df_joined.shape)
+def measure_partition(partition_raw: Path, metric_name: str) -> Tuple[float, int]:
+    # NOTE: the transform holds the whole grid of a month with a value per row and day
+    df = create_dataframe(partition_raw, metric_name).explode(metric_name)
+    return get_row_width(df), df.shape[0]
+
+
+def submit_partition(
+    partition: Tuple[str, Dict[str, str]],
+    path_bikepoints: Path,
+    workdir: Path,
+    use_processes: bool = False,
+) -> PrefectFuture:
+    partition_url, metadata = partition
+    metric_name, metric_date = get_partition_name(partition_url)
+    partition_path = Path(f"{metric_name}/part_{metric_date}.parquet")
 
-    return df_joined
+    partition_raw = fetch.submit(partition_url, workdir=workdir)
+    partition_local = transform.submit(
+        create_partition,
+        partition_raw,
+        workdir / partition_path,
+        args=(path_bikepoints, (metric_name, metric_date)),
+        use_processes=use_processes,
+    )
+    return upload_s3.submit(partition_local, "weather" / partition_path, metadata=metadata)
 
 
-@task()
-def upload_s3(path_local: str, path_remote: str) -> None:
-    AwsCredentials.load("yandex-cloud-s3-credentials")
-    s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
-    s3_block.upload_from_path(from_path=path_local, to_path=path_remote)
+@flow(log_prints=True)
+def process_partitions(
+    partitions_urls: List[str],
+    path_bikepoints: Path,
+    workdir: Path,
+    max_in_flight: int = 3,
+    use_processes: bool = False,
+    force: bool = False,
+    memory_budget_mb: float = 1024,
+) -> None:
+    secret_block = Secret.load("ceda-archive-secret")
 
+    partitions = []
+    for partition_url in partitions_urls:
+        metric_name, metric_date = get_partition_name(partition_url)
+        metadata = check_source(
+            partition_url,
+            f"weather/{metric_name}/part_{metric_date}.parquet",
+            force=force,
+            cookies={"ceda.session.1": secret_block.get()},
+        )
+        if metadata is not None:
+            partitions.append((partition_url, metadata))
+
+    if not partitions:
+        return
 
-@flow(log_prints=True)
-def process_partition(partition_url, df_bikepoints, workdir) -> None:
-    metric_name, metric_date = get_partition_name(partition_url)
-    
-    df_partition = fetch(partition_url, workdir=workdir)
-    df_partition = match_weather_to_bikepoints(
-        df_partition,
-        df_bikepoints,
-        partition_name=(metric_name, metric_date),
+    # NOTE: with `use_processes` set `max_in_flight` around the number of cores keeps all of them busy;
+    #       a partition is transformed whole, so the partitions in flight have to fit into the budget
+    partition_url, _ = partitions[0]
+    metric_name, _ = get_partition_name(partition_url)
+    row_width, num_rows = measure_partition(fetch(partition_url, workdir), metric_name)
+    max_in_flight = get_max_in_flight(row_width, num_rows, memory_budget_mb, max_in_flight)
+    print(f"Memory budget: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, "
+          f"rows={num_rows}, max_in_flight={max_in_flight}")
+
+    process_in_flight(
+        partitions,
+        partial(
+            submit_partition,
+            path_bikepoints=path_bikepoints,
+            workdir=workdir,
+            use_processes=use_processes,
+        ),
+        max_in_flight,
     )
 
-    partition_path = Path(f"{metric_name}/part_{metric_date}.parquet")
-    partition_local = save_partition(df_partition, workdir / partition_path)
-    upload_s3(partition_local, "weather" / partition_path)
-
 
 @flow(log_prints=True)
-def etl_weather_to_s3(partition_num: int, metric: str) -> None:
+def etl_weather_to_s3(partition_num: int, metric: str, force: bool = False, memory_budget_mb: float = 1024) -> None:
     workdir = prepare_env("workdir")
 
     partitions = find_available_partitions(metric)
@@ -180,18 +187,31 @@ def etl_weather_to_s3(partition_num: int, metric: str) -> None:
 
     (workdir / metric).mkdir(parents=True, exist_ok=True)
 
-    df_bikepoints = fetch_bikepoints(workdir)
-    process_partition(partition_url, df_bikepoints, workdir)
+    path_bikepoints = fetch_bikepoints(workdir)
+    process_partitions(
+        [partition_url],
+        path_bikepoints,
+        workdir,
+        max_in_flight=1,
+        force=force,
+        memory_budget_mb=memory_budget_mb,
+    )
 
 
 @flow(log_prints=True)
 def etl_weather_to_s3_multiple(
     partitions_num: List[int] = None,
     metrics: List[str] = ['tasmin', 'tasmax', 'rainfall'],
+    max_in_flight: int = 3,
+    use_processes: bool = False,
+    force: bool = False,
+    memory_budget_mb: float = 1024,
 ) -> None:
     workdir = prepare_env("workdir")
 
-    df_bikepoints = fetch_bikepoints(workdir)
+    path_bikepoints = fetch_bikepoints(workdir)
+
+    partitions_urls = []
 
     for metric in metrics:
         (workdir / metric).mkdir(parents=True, exist_ok=True)
@@ -204,7 +224,20 @@ def etl_weather_to_s3_multiple(
         
         for partition_num in partitions_num:
             partition_url = partitions.get((metric, partition_num))
-            process_partition(partition_url, df_bikepoints, workdir)
+            if partition_url is None:
+                print(f"Partition `{partition_num}` for `{metric}` not found")
+                continue
+            partitions_urls.append(partition_url)
+
+    process_partitions(
+        partitions_urls,
+        path_bikepoints,
+        workdir,
+        max_in_flight=max_in_flight,
+        use_processes=use_processes,
+        force=force,
+        memory_budget_mb=memory_budget_mb,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pathlib import Path
+from functools import reduce
+
+from typing import Dict, List, Tuple
+
+from utils import get_block_size, get_row_width
+
+
+# NOTE: TfL extracts use UK day-first dates, so day-first formats are tried first
+DATETIME_FORMATS = [
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+]
+
+DATETIME_COLUMNS = ["start_datetime", "end_datetime"]
+
+# NOTE: row groups have a fixed size, so the file content does not depend
+#       on the read chunk size and the upload is skipped for the same data
+ROW_GROUP_SIZE = 100_000
+
+
+def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df.columns = df.columns.str.lower().str.replace(' ', '')
+
+    df.rename(columns={
+        "number":             "rental_id",
+        "rentalid":           "rental_id",
+        "bikenumber":         "bike_id",
+        "bikeid":             "bike_id",
+        "enddate":            "end_datetime",
+        "endstationid":       "end_station_id",
+        "endstationnumber":   "end_station_id",
+        "endstationname":     "end_station_name",
+        "endstation":         "end_station_name",
+        "startdate":          "start_datetime",
+        "startstationnumber": "start_station_id",
+        "startstationid":     "start_station_id",
+        "startstationname":   "start_station_name",
+        "startstation":       "start_station_name",
+    }, inplace=True)
+
+    # HOTFIX: because column names and number are incosistent
+    # if "end_station_id" not in df.columns:
+    #     df["end_station_id"] = -1
+
+    columns = [
+        "rental_id",
+        "bike_id",
+        "start_datetime",
+        "start_station_id",
+        "start_station_name",
+        "end_datetime",
+        "end_station_id",
+        "end_station_name",
+    ]
+    return df[columns]
+
+
+def get_datetime_formats(df: pd.DataFrame) -> Dict[str, str]:
+    # NOTE: formats are detected once per file on a sample and used for every chunk,
+    #       otherwise ambiguous dates (e.g. 04/01) could be parsed differently per chunk
+    datetime_formats = {}
+    for col in DATETIME_COLUMNS:
+        values = df[col].dropna()
+        for datetime_format in DATETIME_FORMATS:
+            try:
+                pd.to_datetime(values, format=datetime_format)
+            except ValueError:
+                continue
+            datetime_formats[col] = datetime_format
+            break
+        else:
+            raise ValueError("Unknown datetime format", col, values.head(5).tolist())
+    return datetime_formats
+
+
+def create_dataframe(df: pd.DataFrame, datetime_formats: Dict[str, str]) -> Tuple[pd.DataFrame, int]:
+    df = normalize_columns(df)
+
+    for col in DATETIME_COLUMNS:
+        df[col] = pd.to_datetime(df[col], format=datetime_formats[col])
+
+    for col in ["start_station_name", "end_station_name"]:
+        df[col] = df[col].map(lambda s: re.sub(r"\s*,\s*", ", ", s))
+
+    # NOTE: Drop some incosistent IDs
+
+    mask = []
+    for col in ["rental_id", "bike_id", "start_station_id", "end_station_id"]:
+        mask_ = pd.to_numeric(df[col], errors="coerce").notnull()
+        mask.append(mask_)
+    mask = reduce(np.logical_and, mask)
+
+    df = df[mask]
+
+    for col in ["rental_id", "bike_id", "start_station_id", "end_station_id"]:
+        df[col] = df[col].astype(int)
+
+    return df, int((~mask).sum())
+
+
+def write_partition(
+    path_raw: Path,
+    path: Path,
+    chunksize: int,
+    datetime_formats: Dict[str, str],
+) -> Tuple[int, int]:
+    num_rows, num_dropped = 0, 0
+
+    with pd.read_csv(path_raw, chunksize=chunksize) as reader:
+        writer = None
+        buffer = []
+        try:
+            for df in reader:
+                df, num_dropped_ = create_dataframe(df, datetime_formats)
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, compression="gzip")
+                buffer.append(table.cast(writer.schema))
+                num_rows += df.shape[0]
+                num_dropped += num_dropped_
+
+                # NOTE: only full row groups are written, the tail is kept for the next chunk
+                if sum(t.num_rows for t in buffer) >= ROW_GROUP_SIZE:
+                    table = pa.concat_tables(buffer)
+                    num_full = table.num_rows // ROW_GROUP_SIZE * ROW_GROUP_SIZE
+                    writer.write_table(table.slice(0, num_full), row_group_size=ROW_GROUP_SIZE)
+                    buffer = [table.slice(num_full)]
+
+            if writer is not None and buffer:
+                writer.write_table(pa.concat_tables(buffer), row_group_size=ROW_GROUP_SIZE)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    if writer is None:
+        raise ValueError("No rows are read from the raw partition", path_raw)
+
+    return num_rows, num_dropped
+
+
+def create_partition(path_raw: Path, path: Path, memory_budget_mb: float = 512) -> Tuple[Path, List[str]]:
+    messages = []
+
+    df_sample = pd.read_csv(path_raw, nrows=1000)
+    messages.append(f"columns_raw = {df_sample.columns}")
+
+    datetime_formats = get_datetime_formats(normalize_columns(df_sample.copy()))
+    messages.append(f"datetime_formats = {datetime_formats}")
+
+    row_width = get_row_width(df_sample)
+    chunksize = get_block_size(row_width, memory_budget_mb)
+
+    while True:
+        messages.append(f"Read chunks: memory_budget_mb={memory_budget_mb}, row_width={row_width:.0f}B, chunksize={chunksize}")
+        try:
+            num_rows, num_dropped = write_partition(path_raw, path, chunksize, datetime_formats)
+            break
+        except MemoryError:
+            # NOTE: a last resort, see `insert_blocks`
+            if chunksize == 1:
+                raise
+            chunksize = max(1, chunksize // 2)
+            messages.append("Out of memory, retry with smaller chunks")
+
+    messages.append(f"Drop rows with bad IDs: {num_dropped}")
+    messages.append(f"Partition info:\n{pq.read_schema(path)}")
+    messages.append(f"rows: {num_rows}")
+
+    return path, messages
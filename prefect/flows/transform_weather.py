@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from pathlib import Path
+
+from typing import List, Tuple
+
+
+def create_dataframe(path: Path, metric_name: str) -> pd.DataFrame:
+    import netCDF4 as nc
+
+    try:
+        nc_data = nc.Dataset(path)
+        nc_data_mask = ~nc_data[metric_name][:].mask.all(axis=0)
+        
+        df = pd.DataFrame({
+            'Lat': nc_data['latitude'][:][nc_data_mask],
+            'Lon': nc_data['longitude'][:][nc_data_mask],
+            metric_name: nc_data[metric_name][:][:, nc_data_mask].T.tolist(),
+        })
+    finally:
+        nc_data.close()
+
+    return df
+
+
+def match_weather_to_bikepoints(df_weather, df_bikepoints, partition_name, messages):
+    from sklearn.neighbors import NearestNeighbors
+
+    metric_name, metric_date = partition_name
+    
+    messages.append("Running kNN algroithm")
+    nn = NearestNeighbors(n_neighbors=1, metric='haversine')
+    nn.fit(df_weather[['Lat', 'Lon']])
+    _, indices = nn.kneighbors(df_bikepoints[['Lat', 'Lon']], return_distance=True)
+
+    messages.append("Make joined algorithm")
+    df_joined = pd.DataFrame({
+        'station_id': df_bikepoints['TerminalName'].values,
+        metric_name: df_weather[metric_name].iloc[indices.ravel()],
+    })
+
+    num_days = len(df_joined[metric_name].iloc[0])
+    num_points = df_joined.shape[0]
+    messages.append(f"num_days = {num_days}")
+    messages.append(f"num_points = {num_points}")
+    
+    df_joined = df_joined.explode(metric_name)
+    df_joined['date'] = metric_date * 100 + np.tile(1 + np.arange(num_days), num_points)
+    df_joined['date'] = pd.to_datetime(df_joined['date'].map(str), format='%Y%m%d')
+
+    # NOTE: keep storage compact: narrow integer ids and metrics quantized to 0.01,
+    #       so parquet and ClickHouse codecs compress them well
+    df_joined['station_id'] = df_joined['station_id'].astype('uint32')
+    df_joined[metric_name] = pd.to_numeric(df_joined[metric_name]).astype('float32').round(2)
+    df_joined.reset_index(drop=True, inplace=True)
+
+    messages.append(f"df_joined.shape = {df_joined.shape}")
+
+    return df_joined
+
+
+def create_partition(
+    path_raw: Path,
+    path: Path,
+    path_bikepoints: Path,
+    partition_name: Tuple[str, int],
+) -> Tuple[Path, List[str]]:
+    metric_name, metric_date = partition_name
+    messages = []
+
+    df = create_dataframe(path_raw, metric_name)
+    df = match_weather_to_bikepoints(df, pd.read_parquet(path_bikepoints), partition_name, messages)
+
+    # NOTE: dates stay `datetime64` in pandas and are written as `date32`
+    schema = pa.schema([
+        ('station_id', pa.uint32()),
+        (metric_name, pa.float32()),
+        ('date', pa.date32()),
+    ])
+    df.to_parquet(path, index=False, compression="zstd", schema=schema)
+
+    return path, messages
@@ -0,0 +1,269 @@
+import os
+import sys
+import hashlib
+import requests
+import threading
+import multiprocessing
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from prefect import task
+from prefect.futures import PrefectFuture
+from prefect_aws import AwsCredentials
+from prefect_aws.s3 import S3Bucket
+from botocore.exceptions import ClientError
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from prefect_sqlalchemy import SqlAlchemyConnector
+
+# NOTE: Prefect imports flows by path and removes their directory from `sys.path`
+#       afterwards, spawned workers need it to import the transform modules
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    # NOTE: workers are spawned, a fork of the multithreaded Prefect process could inherit
+    #       held locks and the context of the running task; only paths are sent to workers,
+    #       data is exchanged via parquet files
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _process_pool
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
+
+
+@task(log_prints=True)
+def transform(
+    create_partition: Callable[..., Tuple[Path, List[str]]],
+    path_raw: Path,
+    path: Path,
+    args: Tuple = (),
+    use_processes: bool = False,
+) -> Path:
+    # NOTE: prints of a worker process do not reach the run log,
+    #       so `create_partition` returns its messages to be printed here
+    if use_processes:
+        path, messages = get_process_pool().submit(create_partition, path_raw, path, *args).result()
+    else:
+        path, messages = create_partition(path_raw, path, *args)
+    print(*messages, sep="\n")
+
+    # NOTE: the raw download is not needed once the partition is written
+    path_raw.unlink(missing_ok=True)
+    return path
+
+
+def process_in_flight(
+    items: Iterable[Any],
+    submit: Callable[[Any], Optional[PrefectFuture]],
+    max_in_flight: int = 3,
+) -> None:
+    # NOTE: stages of neighbouring partitions overlap, so partition N+1 is downloading
+    #       while N is transforming and N-1 is uploading; at most `max_in_flight`
+    #       partitions (and their DataFrames) are processed at once;
+    #       `submit` returns None for a skipped partition
+    in_flight = deque()
+
+    try:
+        for item in items:
+            if len(in_flight) >= max_in_flight:
+                in_flight.popleft().wait()
+            future = submit(item)
+            if future is not None:
+                in_flight.append(future)
+
+        for future in in_flight:
+            future.wait()
+    finally:
+        shutdown_process_pool()
+
+
+# NOTE: a parsed chunk or a rendered insert takes a few times more memory
+#       than its rows in a DataFrame
+BLOCK_MEMORY_FACTOR = 4
+
+
+def get_row_width(df: "pd.DataFrame") -> float:
+    return df.memory_usage(deep=True).sum() / max(df.shape[0], 1)
+
+
+def get_block_size(row_width: float, memory_budget_mb: float, max_block_size: int = 1_000_000) -> int:
+    block_size = memory_budget_mb * 2 ** 20 // (BLOCK_MEMORY_FACTOR * max(row_width, 1))
+    return int(max(1, min(max_block_size, block_size)))
+
+
+def get_max_in_flight(row_width: float, min_block_size: int, memory_budget_mb: float, max_in_flight: int) -> int:
+    # NOTE: every partition in flight has to get a share of the budget
+    #       that still fits `min_block_size` rows
+    partition_mb = BLOCK_MEMORY_FACTOR * max(row_width, 1) * min_block_size / 2 ** 20
+    return int(max(1, min(max_in_flight, memory_budget_mb // partition_mb)))
+
+
+def insert_blocks(df: "pd.DataFrame", table: str, con: "SqlAlchemyConnector", block_size: int) -> int:
+    # NOTE: block sizes are derived from the budget up front, the Linux OOM killer
+    #       usually ends the process before MemoryError is raised; when it is raised
+    #       (e.g. under a ulimit) the block is retried with halved size as a last resort,
+    #       the degraded size is returned to be used for the following blocks
+    start = 0
+    while start < df.shape[0]:
+        try:
+            df.iloc[start:start + block_size].to_sql(
+                name=table,
+                con=con.get_engine(),
+                chunksize=block_size,
+                if_exists="append",
+                index=False,
+            )
+        except MemoryError:
+            if block_size == 1:
+                raise
+            block_size = max(1, block_size // 2)
+            print("Out of memory, retry with smaller blocks: block_size =", block_size)
+            continue
+        start += block_size
+    return block_size
+
+
+def get_local_hash(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with Path(path).open('rb') as fd:
+        for data in iter(lambda: fd.read(chunk_size), b''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def get_s3_key(s3_block: S3Bucket, path_remote: str) -> str:
+    key = str(path_remote)
+    if s3_block.bucket_folder:
+        key = (Path(s3_block.bucket_folder) / key).as_posix()
+    return key
+
+
+def get_remote_metadata(s3_block: S3Bucket, path_remote: str) -> Optional[Dict[str, str]]:
+    # NOTE: ETag is MD5 of the content only for single part uploads,
+    #       so the hash is stored in the object metadata on upload
+    try:
+        head = s3_block.credentials.get_s3_client().head_object(
+            Bucket=s3_block.bucket_name,
+            Key=get_s3_key(s3_block, path_remote),
+        )
+    except ClientError:
+        return None
+    return {"md5": head["ETag"].strip('"'), **head["Metadata"]}
+
+
+def get_remote_hash(s3_block: S3Bucket, path_remote: str) -> Optional[str]:
+    metadata = get_remote_metadata(s3_block, path_remote)
+    return None if metadata is None else metadata["md5"]
+
+
+@task(log_prints=True)
+def upload_s3(path_local: str, path_remote: str, metadata: Optional[Dict[str, str]] = None) -> bool:
+    AwsCredentials.load("yandex-cloud-s3-credentials")
+    s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
+
+    metadata = {**(metadata or {}), "md5": get_local_hash(path_local)}
+    remote_metadata = get_remote_metadata(s3_block, path_remote)
+
+    if remote_metadata is not None and remote_metadata["md5"] == metadata["md5"]:
+        if metadata.items() <= remote_metadata.items():
+            print("Content is not changed, skip upload:", path_remote)
+            return False
+
+        # NOTE: the content is the same, only the metadata (e.g. the source version) is refreshed
+        key = get_s3_key(s3_block, path_remote)
+        s3_block.credentials.get_s3_client().copy_object(
+            Bucket=s3_block.bucket_name,
+            Key=key,
+            CopySource={"Bucket": s3_block.bucket_name, "Key": key},
+            Metadata=metadata,
+            MetadataDirective="REPLACE",
+        )
+        print("Content is not changed, update metadata:", path_remote)
+        return False
+
+    s3_block.upload_from_path(
+        from_path=path_local,
+        to_path=path_remote,
+        ExtraArgs={"Metadata": metadata},
+    )
+    return True
+
+
+def get_source_version(
+    url: str,
+    headers: Optional[Dict[str, str]] = None,
+    cookies: Optional[Dict[str, str]] = None,
+) -> Optional[str]:
+    page = requests.head(url, headers=headers, cookies=cookies, allow_redirects=True)
+    page.raise_for_status()
+    return page.headers.get("ETag", page.headers.get("Last-Modified"))
+
+
+@task(retries=2, log_prints=True)
+def check_source(
+    url: str,
+    path_remote: str,
+    force: bool = False,
+    headers: Optional[Dict[str, str]] = None,
+    cookies: Optional[Dict[str, str]] = None,
+) -> Optional[Dict[str, str]]:
+    # NOTE: the version of the source is stored in the metadata of the uploaded object,
+    #       None is returned when it is not changed and the partition can be skipped
+    #       without downloading it
+    version = get_source_version(url, headers=headers, cookies=cookies)
+    if version is None:
+        return {}
+
+    if not force:
+        AwsCredentials.load("yandex-cloud-s3-credentials")
+        s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
+
+        metadata = get_remote_metadata(s3_block, path_remote)
+        if metadata is not None and metadata.get("source") == version:
+            print("Source is not changed since the last upload, skip:", url)
+            return None
+
+    return {"source": version}
+
+
+@task()
+def get_version(paths_remote: List[str]) -> Optional[str]:
+    AwsCredentials.load("yandex-cloud-s3-credentials")
+    s3_block = S3Bucket.load("yandex-cloud-s3-bucket")
+
+    hashes = [get_remote_hash(s3_block, p) for p in paths_remote]
+    if None in hashes:
+        return None
+    return ",".join(hashes)
+
+
+def is_loaded(marker: Path, version: Optional[str]) -> bool:
+    return version is not None and marker.exists() and marker.read_text() == version
+
+
+def mark_loaded(marker: Path, version: Optional[str]) -> None:
+    if version is None:
+        return
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.write_text(version)